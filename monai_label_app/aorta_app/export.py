@@ -0,0 +1,252 @@
+"""
+Export the aortic segmentation UNet to ONNX and build a TensorRT engine for the MONAI Label app
+
+The engine is written next to the model weights (``model/aorta_segmentation_unet.engine``) where
+``AortaSegmentation`` picks it up to run the sliding window forward passes. See ``export_aoti.py`` for the
+pure PyTorch AOTInductor package.
+
+Usage:
+    python export.py --model model/aorta_segmentation_unet.pt
+    python export.py --model model/aorta_segmentation_unet.pt --int8 --calib-images /path/to/studies
+"""
+
+import argparse
+import glob
+import logging
+import os
+from collections.abc import Sequence
+from typing import Optional
+
+import tensorrt as trt
+import torch
+from lib.configs import INFERENCE_CONFIG, NETWORK_CONFIG
+from lib.networks import fuse_conv_norm, load_network
+from lib.transforms import build_pre_transforms
+from monai.transforms import Compose, RandSpatialCropd, SpatialPadd
+
+logger = logging.getLogger(__name__)
+
+ONNX_OPSET = 17
+
+
+def export_onnx(model_path: str, onnx_path: str) -> str:
+    """
+    Trace the UNet to ONNX with a dynamic window batch dimension
+
+    Conv+Norm pairs are fused first when the server fuses them, so the engine runs the same network.
+    """
+    network = load_network(model_path)
+    if INFERENCE_CONFIG["fuse_norm"]:
+        network = fuse_conv_norm(network)
+    example = torch.zeros((1, NETWORK_CONFIG["in_channels"], *INFERENCE_CONFIG["roi_size"]))
+
+    torch.onnx.export(
+        network,
+        example,
+        onnx_path,
+        input_names=["x"],
+        output_names=["y"],
+        dynamic_axes={"x": {0: "N"}, "y": {0: "N"}},
+        opset_version=ONNX_OPSET,
+    )
+    logger.info(f"Exported ONNX model: {onnx_path}")
+    return onnx_path
+
+
+class Int8Calibrator(trt.IInt8EntropyCalibrator2):
+    """
+    Entropy calibrator feeding randomly cropped, pre-processed CT windows to the TensorRT builder
+    """
+
+    def __init__(
+        self,
+        images: Sequence[str],
+        cache_path: str,
+        batch_size: int = 1,
+        num_crops: int = 4,
+    ):
+        super().__init__()
+
+        roi_size = INFERENCE_CONFIG["roi_size"]
+        pre_transforms = build_pre_transforms()
+        crop = Compose(
+            [
+                SpatialPadd(keys="image", spatial_size=roi_size),
+                RandSpatialCropd(keys="image", roi_size=roi_size, random_size=False),
+            ]
+        )
+
+        windows = []
+        for image in images:
+            data = pre_transforms({"image": image})
+            windows.extend(torch.as_tensor(crop(data)["image"]) for _ in range(num_crops))
+
+        self.cache_path = cache_path
+        self.batch_size = batch_size
+        self.windows = windows
+        self.index = 0
+        self.device_input = torch.empty((batch_size, 1, *roi_size), dtype=torch.float32, device="cuda")
+
+    def get_batch_size(self) -> int:
+        return self.batch_size
+
+    def get_batch(self, names: Sequence[str]) -> Optional[list[int]]:  # noqa: ARG002
+        if self.index + self.batch_size > len(self.windows):
+            return None
+
+        batch = torch.stack(self.windows[self.index : self.index + self.batch_size])
+        self.device_input.copy_(batch)
+        self.index += self.batch_size
+        return [self.device_input.data_ptr()]
+
+    def read_calibration_cache(self) -> Optional[bytes]:
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, "rb") as f:
+                return f.read()
+        return None
+
+    def write_calibration_cache(self, cache: bytes):
+        with open(self.cache_path, "wb") as f:
+            f.write(cache)
+
+
+def keep_sensitive_layers(network: trt.INetworkDefinition):
+    """
+    Pin the convolutions reading the network input (stem) and producing its output (head) to FP16 in INT8 engines
+
+    The layers are found from the input and output tensors rather than by position: in MONAI's ``ResidualUnit`` the
+    residual convolution also reads the block input, and may come first in topological order.
+    """
+    layers = [network.get_layer(i) for i in range(network.num_layers)]
+    consumers, producers = {}, {}
+    for layer in layers:
+        for i in range(layer.num_inputs):
+            tensor = layer.get_input(i)
+            if tensor is not None:
+                consumers.setdefault(tensor.name, []).append(layer)
+        for i in range(layer.num_outputs):
+            producers[layer.get_output(i).name] = layer
+
+    def nearest_convs(names: list[str], forward: bool) -> list[trt.ILayer]:
+        # walk from the tensors through the layers in between (casts, reshapes, activations) to the convolutions
+        conv_types = (trt.LayerType.CONVOLUTION, trt.LayerType.DECONVOLUTION)
+        convs, seen = [], set()
+        while names:
+            name = names.pop()
+            for layer in consumers.get(name, []) if forward else [producers.get(name)]:
+                if layer is None or layer.name in seen:
+                    continue
+                seen.add(layer.name)
+                if layer.type in conv_types:
+                    convs.append(layer)
+                elif forward:
+                    names += [layer.get_output(i).name for i in range(layer.num_outputs)]
+                else:
+                    names += [t.name for t in (layer.get_input(i) for i in range(layer.num_inputs)) if t is not None]
+        return convs
+
+    stem = nearest_convs([network.get_input(i).name for i in range(network.num_inputs)], forward=True)
+    head = nearest_convs([network.get_output(i).name for i in range(network.num_outputs)], forward=False)
+    if not stem and not head:
+        logger.warning("No convolutions found next to the network input or output; nothing kept in FP16")
+        return
+
+    for layer in {layer.name: layer for layer in stem + head}.values():
+        layer.precision = trt.float16
+        for i in range(layer.num_outputs):
+            layer.set_output_type(i, trt.float16)
+        logger.info(f"Keeping layer in FP16: {layer.name}")
+
+
+def build_engine(
+    onnx_path: str,
+    engine_path: str,
+    fp16: bool = True,
+    calibrator: Optional[Int8Calibrator] = None,
+) -> str:
+    """
+    Build a serialized TensorRT engine from the ONNX model
+
+    Equivalent to ``trtexec --onnx=... --fp16 --minShapes=x:1x1x96x96x96 --optShapes=x:4x1x96x96x96``
+    with the maximum batch set to the inferer ``sw_batch_size``.
+    """
+    trt_logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(trt_logger)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, trt_logger)
+
+    with open(onnx_path, "rb") as f:
+        if not parser.parse(f.read()):
+            errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+            raise RuntimeError(f"Failed to parse ONNX model {onnx_path}: {errors}")
+
+    window = (NETWORK_CONFIG["in_channels"], *INFERENCE_CONFIG["roi_size"])
+    sw_batch_size = INFERENCE_CONFIG["sw_batch_size"]
+    profile = builder.create_optimization_profile()
+    profile.set_shape("x", (1, *window), (sw_batch_size, *window), (sw_batch_size, *window))
+
+    config = builder.create_builder_config()
+    config.add_optimization_profile(profile)
+    if calibrator is not None and not fp16:
+        raise ValueError("INT8 engines keep the stem and head in FP16, so they cannot be built without FP16")
+    if fp16:
+        config.set_flag(trt.BuilderFlag.FP16)
+    if calibrator is not None:
+        # calibration runs at the opt shape of its profile, which must match the batches the calibrator returns
+        batch = (calibrator.get_batch_size(), *window)
+        calibration_profile = builder.create_optimization_profile()
+        calibration_profile.set_shape("x", batch, batch, batch)
+
+        config.set_flag(trt.BuilderFlag.INT8)
+        config.int8_calibrator = calibrator
+        config.set_calibration_profile(calibration_profile)
+        keep_sensitive_layers(network)
+        config.set_flag(trt.BuilderFlag.OBEY_PRECISION_CONSTRAINTS)
+
+    serialized = builder.build_serialized_network(network, config)
+    if serialized is None:
+        raise RuntimeError(f"Failed to build TensorRT engine from {onnx_path}")
+
+    with open(engine_path, "wb") as f:
+        f.write(serialized)
+    logger.info(f"Built TensorRT engine: {engine_path}")
+    return engine_path
+
+
+def build_int8_engine(model_path: str, images: Sequence[str]) -> str:
+    """
+    Export the model and build an INT8 engine calibrated on the given volumes, next to the model file
+    """
+    base = os.path.splitext(model_path)[0]
+    onnx_path = export_onnx(model_path, base + ".onnx")
+    calibrator = Int8Calibrator(images, cache_path=base + ".calib")
+    return build_engine(onnx_path, base + ".engine", calibrator=calibrator)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the aortic segmentation UNet to TensorRT")
+    parser.add_argument("--model", default=os.path.join("model", "aorta_segmentation_unet.pt"))
+    parser.add_argument("--no-fp16", action="store_true", help="Build the engine in FP32")
+    parser.add_argument("--int8", action="store_true", help="Enable INT8 with entropy calibration")
+    parser.add_argument("--calib-images", help="Directory of NIfTI volumes used for INT8 calibration")
+    parser.add_argument("--calib-volumes", type=int, default=8, help="Number of volumes used for calibration")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.int8:
+        if not args.calib_images:
+            parser.error("--int8 requires --calib-images")
+        if args.no_fp16:
+            parser.error("--int8 keeps the stem and head in FP16 and cannot be combined with --no-fp16")
+        images = sorted(glob.glob(os.path.join(args.calib_images, "*.nii*")))[: args.calib_volumes]
+        build_int8_engine(args.model, images)
+        return
+
+    base = os.path.splitext(args.model)[0]
+    onnx_path = export_onnx(args.model, base + ".onnx")
+    build_engine(onnx_path, base + ".engine", fp16=not args.no_fp16)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Build an AOTInductor package of the aortic segmentation UNet for the MONAI Label app
+
+The package is written next to the model weights (``model/aorta_segmentation_unet.pt2``) where
+``AortaSegmentation`` picks it up on CUDA devices when there is no TensorRT engine. Only PyTorch is needed.
+
+Usage:
+    python export_aoti.py --model model/aorta_segmentation_unet.pt
+"""
+
+import argparse
+import logging
+import os
+
+from lib.configs import INFERENCE_CONFIG, NETWORK_CONFIG
+from lib.networks import build_aoti_package, fuse_conv_norm, load_network
+
+logger = logging.getLogger(__name__)
+
+
+def build_aoti(model_path: str) -> str:
+    """
+    Build an AOTInductor package of the network for CUDA next to the model file
+    """
+    network = load_network(model_path)
+    if INFERENCE_CONFIG["fuse_norm"]:
+        network = fuse_conv_norm(network)
+
+    return build_aoti_package(
+        network,
+        os.path.splitext(model_path)[0] + ".pt2",
+        roi_size=INFERENCE_CONFIG["roi_size"],
+        max_batch_size=INFERENCE_CONFIG["sw_batch_size"],
+        in_channels=NETWORK_CONFIG["in_channels"],
+        half=INFERENCE_CONFIG["amp"],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an AOTInductor package of the aortic segmentation UNet")
+    parser.add_argument("--model", default=os.path.join("model", "aorta_segmentation_unet.pt"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    build_aoti(args.model)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,10 @@ INTENSITY_RANGE = {
 
 TARGET_SPACING = [1.5, 1.5, 2.0]  # mm
 
+FOREGROUND_PERCENTILES = [33.0, 99.5]  # Intensity window for the Otsu foreground threshold
+
+PREFETCH_WORKERS = 4  # Threads reading (and decompressing) volumes ahead of the inference requests
+
 NETWORK_CONFIG = {
     "spatial_dims": 3,
     "in_channels": 1,
@@ -22,7 +26,29 @@ NETWORK_CONFIG = {
     "num_res_units": 2,
 }
 
-INFERENCE_CONFIG = {"roi_size": SPATIAL_SIZE, "sw_batch_size": 4, "overlap": 0.5}
+INFERENCE_CONFIG = {
+    "roi_size": SPATIAL_SIZE,
+    "sw_batch_size": 4,
+    "overlap": 0.5,  # Final (non-interactive) requests
+    "mode": "gaussian",
+    "interactive_overlap": 0.25,  # Interactive requests: ~3.4x fewer windows than 0.5 overlap
+    "interactive_mode": "constant",
+    "sigma_scale": 0.125,
+    "sw_device": None,  # Device for the window forward passes (None: the request device)
+    "device": "cpu",  # Device for the stitched output; keeps the full 24-class volume out of GPU memory
+    "buffer_steps": 1,  # Window rows buffered on sw_device before flushing to device (only used with device="cpu")
+    "buffer_dim": -1,
+    "amp": True,  # FP16 autocast for the window forward passes (CUDA only)
+    "channels_last": True,  # channels_last_3d network weights and windows (CUDA only)
+    "fp16_buffers": True,  # Stitch the output probabilities in FP16 (only the argmax is used)
+    "pool_buffers": False,  # Reuse the stitching buffers across requests (pinned when stitching on CPU)
+    "pool_bytes": 1 << 30,  # Cap on the memory kept by the pooled buffers of all inferers and threads (see README)
+    "fuse_norm": True,  # Fold eval-mode batch norms into the convolutions (instance norms are kept)
+    "compile": True,  # torch.compile the intensity scaling, and the network on CUDA unless a TensorRT engine is used
+    "cuda_graphs": True,  # Replay the window forward from a captured CUDA graph on CUDA devices
+    "tensorrt": True,  # Use the TensorRT engine next to the model file (built by export.py) when present
+    "aoti": True,  # Use the AOTInductor package next to the model file (export_aoti.py) when there is no engine
+}
 
 LABEL_NAMES = {
     0: "background",
@@ -1,27 +1,38 @@
 import logging
 import os
 from collections.abc import Sequence
+from functools import partial
 from typing import Callable, Optional
 
 import torch
-from monai.inferers import SlidingWindowInferer
 from monai.networks.nets import UNet
 from monai.transforms import (
     Activationsd,
     AsDiscreted,
     Compose,
-    CropForegroundd,
-    EnsureChannelFirstd,
+    CopyItemsd,
     EnsureTyped,
-    LoadImaged,
-    Orientationd,
-    ScaleIntensityRanged,
-    Spacingd,
 )
 from monailabel.interfaces.tasks.infer import InferTask
-from monailabel.utils.others.generic import gpu_memory_map
+from monailabel.utils.others.generic import gpu_memory_map, name_to_device, strtobool
 
-from .configs import INFERENCE_CONFIG, INTENSITY_RANGE, NETWORK_CONFIG, TARGET_SPACING
+from .configs import (
+    FOREGROUND_PERCENTILES,
+    INFERENCE_CONFIG,
+    INTENSITY_RANGE,
+    NETWORK_CONFIG,
+    PREFETCH_WORKERS,
+    TARGET_SPACING,
+)
+from .inferers import (
+    AortaSlidingWindowInferer,
+    AOTInductorPredictor,
+    CUDAGraphPredictor,
+    PoolBudget,
+    TensorRTPredictor,
+)
+from .networks import aoti_supported, fuse_conv_norm
+from .transforms import OtsuCropForegroundd, PrefetchLoadImaged, ScaleIntensityRangeTensord, build_pre_transforms
 
 logger = logging.getLogger(__name__)
 
@@ -39,6 +50,13 @@ class AortaSegmentation(InferTask):
         preload: bool = False,
         config: Optional[dict] = None,
     ):
+        self.model_path = path
+        self.engine_path = os.path.splitext(path)[0] + ".engine"
+        self.package_path = os.path.splitext(path)[0] + ".pt2"
+        self._predictors: dict[str, Optional[Callable[..., torch.Tensor]]] = {}
+        self._valid = False
+        self._optimized_networks: dict[str, torch.nn.Module] = {}
+
         super().__init__(
             path=path,
             network=network,
@@ -54,58 +72,135 @@ class AortaSegmentation(InferTask):
         else:
             self.network = network
 
-    def pre_transforms(self, data: Optional[dict] = None) -> Compose:  # noqa: ARG002
+        # the pipelines (pre-processing once per device) and the inferers (with their weight maps) are built once
+        # and reused by every request
+        # prefetched studies are inferred on the default request device; pinning only pays off for a CUDA copy
+        pin_memory = torch.device(name_to_device(None)).type == "cuda"
+        self._loader = PrefetchLoadImaged(keys="image", num_workers=PREFETCH_WORKERS, pin_memory=pin_memory)
+        self._scale_intensity = ScaleIntensityRangeTensord(
+            keys="image",
+            a_min=INTENSITY_RANGE["a_min"],
+            a_max=INTENSITY_RANGE["a_max"],
+            b_min=INTENSITY_RANGE["b_min"],
+            b_max=INTENSITY_RANGE["b_max"],
+            fused=INFERENCE_CONFIG["compile"],
+        )
+        self._crop_foreground = OtsuCropForegroundd(
+            keys="image", source_key="image", percentiles=FOREGROUND_PERCENTILES
+        )
+        self._pre_transforms: dict[str, Compose] = {}
+        self._inverse_transforms = {probs: self._build_inverse_transforms(probs) for probs in (False, True)}
+        self._post_transforms = self._build_post_transforms()
+        self._pool_budget = PoolBudget(INFERENCE_CONFIG["pool_bytes"])
+        self._inferers = {interactive: self._build_inferer(interactive) for interactive in (False, True)}
+
+    def pre_transforms(self, data: Optional[dict] = None) -> Compose:
         """
-        Pre-processing transforms matching the training pipeline
+        Pre-processing transforms matching the training pipeline, running on the device of the request
         """
-        return Compose(
-            [
-                LoadImaged(keys="image"),
-                EnsureChannelFirstd(keys="image"),
-                ScaleIntensityRanged(
-                    keys="image",
-                    a_min=INTENSITY_RANGE["a_min"],
-                    a_max=INTENSITY_RANGE["a_max"],
-                    b_min=INTENSITY_RANGE["b_min"],
-                    b_max=INTENSITY_RANGE["b_max"],
-                    clip=True,
-                ),
-                CropForegroundd(keys="image", source_key="image"),
-                Orientationd(keys="image", axcodes="RAS"),
-                Spacingd(
-                    keys="image",
-                    pixdim=TARGET_SPACING,
-                    mode="bilinear",
-                ),
-                EnsureTyped(keys="image"),
-            ]
+        device = name_to_device(data.get("device") if data else None)
+        if device not in self._pre_transforms:
+            self._pre_transforms[device] = self._build_pre_transforms(device)
+        return self._pre_transforms[device]
+
+    def inferer(self, data: Optional[dict] = None) -> Callable:
+        """
+        Sliding window inferer for large volume inference, with the predictor exported for the request device
+        """
+        inferer = self._inferers[strtobool(data.get("interactive", True)) if data else True]
+        return partial(self._infer, inferer, name_to_device(data.get("device") if data else None))
+
+    def _infer(
+        self,
+        inferer: AortaSlidingWindowInferer,
+        device: str,
+        inputs: torch.Tensor,
+        network: Callable[..., torch.Tensor],
+    ) -> torch.Tensor:
+        """
+        Run the inferer with the predictor exported for the device, if any
+        """
+        return inferer(inputs, network, predictor=self._predictors.get(device))
+
+    def inverse_transforms(self, data: Optional[dict] = None) -> Compose:
+        """
+        Inverse transforms to restore original spacing and orientation
+        """
+        return self._inverse_transforms[bool(data and strtobool(data.get("return_probs", False)))]
+
+    def post_transforms(self, data: Optional[dict] = None) -> Compose:  # noqa: ARG002
+        """
+        Post-processing transforms
+        """
+        return self._post_transforms
+
+    def prefetch(self, path: str):
+        """
+        Start loading an image in the background, ahead of its inference request
+        """
+        self._loader.prefetch(path)
+
+    def _build_pre_transforms(self, device: str) -> Compose:
+        """
+        Build the pre-processing pipeline for a device, sharing the loader, scaling and cropping transforms
+        """
+        return build_pre_transforms(
+            device,
+            loader=self._loader,
+            scale_intensity=self._scale_intensity,
+            crop_foreground=self._crop_foreground,
         )
 
-    def inferer(self, data: Optional[dict] = None) -> Callable:  # noqa: ARG002
+    def _build_inferer(self, interactive: bool) -> AortaSlidingWindowInferer:
         """
-        Sliding window inferer for large volume inference
+        Build the sliding window inferer for interactive or final requests; the weight map is computed once and
+        cached on it
         """
-        return SlidingWindowInferer(
+        # buffering only saves memory when the stitched output lives in CPU memory
+        device = INFERENCE_CONFIG["device"]
+        buffered = device is not None and torch.device(device).type == "cpu"
+
+        return AortaSlidingWindowInferer(
             roi_size=INFERENCE_CONFIG["roi_size"],
             sw_batch_size=INFERENCE_CONFIG["sw_batch_size"],
-            overlap=INFERENCE_CONFIG["overlap"],
+            overlap=INFERENCE_CONFIG["interactive_overlap" if interactive else "overlap"],
+            mode=INFERENCE_CONFIG["interactive_mode" if interactive else "mode"],
+            sigma_scale=INFERENCE_CONFIG["sigma_scale"],
+            sw_device=INFERENCE_CONFIG["sw_device"],
+            device=device,
+            cache_roi_weight_map=True,
+            buffer_steps=INFERENCE_CONFIG["buffer_steps"] if buffered else None,
+            buffer_dim=INFERENCE_CONFIG["buffer_dim"],
+            amp=INFERENCE_CONFIG["amp"],
+            buffer_dtype=torch.float16 if INFERENCE_CONFIG["fp16_buffers"] else None,
+            channels_last=INFERENCE_CONFIG["channels_last"] and torch.cuda.is_available(),
+            pool_buffers=INFERENCE_CONFIG["pool_buffers"],
+            pool_budget=self._pool_budget,
         )
 
-    def inverse_transforms(self, data: Optional[dict] = None) -> Compose:  # noqa: ARG002
+    def _build_inverse_transforms(self, return_probs: bool) -> Compose:
         """
-        Inverse transforms to restore original spacing and orientation
+        Build the inverse pipeline, adding softmax probabilities when the request asks for them
         """
-        return Compose(
-            [
-                EnsureTyped(keys="pred", device="cpu", track_meta=False),
-                Activationsd(keys="pred", softmax=True),
-                AsDiscreted(keys="pred", argmax=True),
+        transforms = []
+        if return_probs:
+            transforms += [
+                CopyItemsd(keys="pred", names="probs"),
+                Activationsd(keys="probs", softmax=True),
+                EnsureTyped(keys="probs", device="cpu", track_meta=False),
             ]
-        )
+        # reduce to the label map before the host copy: when the output is stitched on the inference device
+        # ("device": None in INFERENCE_CONFIG) only uint8 labels leave it; with the default CPU stitching
+        # ("device": "cpu") the output is already on the host and the argmax runs on the CPU
+        transforms += [
+            AsDiscreted(keys="pred", argmax=True, dtype=torch.uint8),
+            EnsureTyped(keys="pred", device="cpu", track_meta=False),
+        ]
+        return Compose(transforms)
 
-    def post_transforms(self, data: Optional[dict] = None) -> Compose:  # noqa: ARG002
+    def _build_post_transforms(self) -> Compose:
         """
-        Post-processing transforms
+        Build the post-processing pipeline
         """
         return Compose(
             [
@@ -113,6 +208,55 @@ class AortaSegmentation(InferTask):
             ]
         )
 
+    def _load_predictor(self, device: str, model_mtime: float) -> Optional[Callable[..., torch.Tensor]]:
+        """
+        Load the predictor replacing the network for the window forward passes on a CUDA device: the TensorRT
+        engine, else the AOTInductor package, if either was exported for the current weights
+        """
+        if torch.device(device).type != "cuda":
+            return None
+        return self._load_trt_predictor(device, model_mtime) or self._load_aoti_predictor(device, model_mtime)
+
+    def _load_aoti_predictor(self, device: str, model_mtime: float) -> Optional[AOTInductorPredictor]:
+        """
+        Load the AOTInductor package predictor on the device if a package was built for this model (and the installed
+        torch can load it)
+        """
+        if not INFERENCE_CONFIG["aoti"] or not aoti_supported():
+            return None
+        return self._load_exported(self.package_path, device, AOTInductorPredictor, model_mtime)
+
+    def _load_trt_predictor(self, device: str, model_mtime: float) -> Optional[TensorRTPredictor]:
+        """
+        Load the TensorRT engine predictor on the device if an engine was exported for this model
+        """
+        if not INFERENCE_CONFIG["tensorrt"]:
+            return None
+        load = partial(
+            TensorRTPredictor,
+            roi_size=INFERENCE_CONFIG["roi_size"],
+            sw_batch_size=INFERENCE_CONFIG["sw_batch_size"],
+            out_channels=NETWORK_CONFIG["out_channels"],
+        )
+        return self._load_exported(self.engine_path, device, load, model_mtime)
+
+    def _load_exported(
+        self,
+        path: str,
+        device: str,
+        load: Callable[..., Callable[..., torch.Tensor]],
+        model_mtime: float,
+    ) -> Optional[Callable[..., torch.Tensor]]:
+        """
+        Load a model exported next to the weights on the device, unless it is older than the weights
+        """
+        if not os.path.exists(path):
+            return None
+        if os.path.getmtime(path) < model_mtime:
+            logger.warning(f"Ignoring {path}: it is older than the model weights {self.model_path}; rebuild it")
+            return None
+        return load(path, device=device)
+
     def __call__(self, request: dict, datastore: Optional[dict] = None) -> dict:
         """
         Execute inference on the input request
@@ -127,19 +271,90 @@ class AortaSegmentation(InferTask):
         logger.info("Aortic segmentation inference completed")
         return result
 
+    def _get_network(self, device: str, data: Optional[dict]) -> Optional[torch.nn.Module]:
+        """
+        Get the network loaded for the device, optimized for inference the first time it is loaded
+        """
+        network = super()._get_network(device, data)
+        if network is None or self._optimized_networks.get(device) is network:
+            return network
+
+        self._predictors[device] = self._load_predictor(device, self._networks[device][1])
+        network = self._optimize_network(network, device)
+        self._optimized_networks[device] = network
+
+        # keep the optimized module in the base task cache so it is reused until the model file changes
+        self._networks[device] = (network, self._networks[device][1])
+        return network
+
+    def _optimize_network(self, network: torch.nn.Module, device: str) -> torch.nn.Module:
+        """
+        Fuse Conv+Norm, then on CUDA devices convert to channels_last_3d, compile with torch.compile and capture
+        the window forward in a CUDA graph
+        """
+        if INFERENCE_CONFIG["fuse_norm"]:
+            network = fuse_conv_norm(network)
+
+        if not str(device).startswith("cuda") or self._predictors.get(device) is not None:
+            return network
+
+        memory_format = torch.contiguous_format
+        if INFERENCE_CONFIG["channels_last"]:
+            memory_format = torch.channels_last_3d
+            network = network.to(memory_format=memory_format)
+
+        if INFERENCE_CONFIG["compile"]:
+            logger.info(f"Compiling network for device: {device}")
+            torch._dynamo.config.cache_size_limit = 64
+            # reduce-overhead records CUDA graphs of its own, which cannot be nested in the captured graph
+            mode = "default" if INFERENCE_CONFIG["cuda_graphs"] else "reduce-overhead"
+            network = torch.compile(network, mode=mode, fullgraph=False, dynamic=False)
+
+        if INFERENCE_CONFIG["cuda_graphs"]:
+            # the warmup before the capture also pays the compile cost
+            return CUDAGraphPredictor(
+                network,
+                roi_size=INFERENCE_CONFIG["roi_size"],
+                sw_batch_size=INFERENCE_CONFIG["sw_batch_size"],
+                in_channels=NETWORK_CONFIG["in_channels"],
+                device=device,
+                amp=INFERENCE_CONFIG["amp"],
+                memory_format=memory_format,
+            )
+
+        if INFERENCE_CONFIG["compile"]:
+            self._warmup(network, device)
+        return network
+
+    def _warmup(self, network: torch.nn.Module, device: str):
+        """
+        Run a forward pass on a full batch of empty windows to pay the compile cost before the first request
+        """
+        roi_size = INFERENCE_CONFIG["roi_size"]
+        inputs = torch.zeros((INFERENCE_CONFIG["sw_batch_size"], 1, *roi_size), device=device)
+        if INFERENCE_CONFIG["channels_last"]:
+            inputs = inputs.to(memory_format=torch.channels_last_3d)
+        autocast = torch.autocast(device_type="cuda", dtype=torch.float16, enabled=INFERENCE_CONFIG["amp"])
+        with torch.inference_mode(), autocast:
+            network(inputs)
+
     def get_path(self) -> str:
         """
         Get the model path
         """
-        return self.path
+        return self.model_path
 
     def is_valid(self) -> bool:
         """
         Check if the model file exists and is valid
         """
-        if not os.path.exists(self.path):
-            logger.warning(f"Model file not found: {self.path}")
+        if self._valid:
+            return True
+        # the base task keeps self.path as a list of candidate paths
+        if not os.path.exists(self.model_path):
+            logger.warning(f"Model file not found: {self.model_path}")
             return False
+        self._valid = True
         return True
 
     def get_config(self) -> dict:
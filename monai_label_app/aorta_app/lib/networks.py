@@ -0,0 +1,144 @@
+import logging
+import os
+from collections.abc import Sequence
+
+import torch
+from monai.networks.blocks import Convolution
+from monai.networks.nets import UNet
+from monai.utils import pytorch_after
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from .configs import NETWORK_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# torch._inductor.aoti_compile_and_package(program, package_path=...) and aoti_load_package(path)
+AOTI_TORCH_VERSION = (2, 6)
+
+
+def aoti_supported() -> bool:
+    """
+    Whether the installed torch builds and loads AOTInductor packages with the API used here
+    """
+    return pytorch_after(*AOTI_TORCH_VERSION)
+
+
+def load_network(model_path: str) -> UNet:
+    """
+    Build the UNet and load the trained weights
+    """
+    network = UNet(**NETWORK_CONFIG)
+    checkpoint = torch.load(model_path, map_location="cpu")
+    network.load_state_dict(checkpoint.get("model", checkpoint))
+    return network.eval()
+
+
+def fuse_conv_norm(network: torch.nn.Module) -> torch.nn.Module:
+    """
+    Fold eval-mode batch norms into the preceding convolutions and drop the inactive dropout layers
+
+    Instance norms normalize every window with its own statistics, so they cannot be folded and are left in place.
+    Must run on a network in eval mode, before it is compiled or exported.
+    """
+    fused = 0
+    for module in network.modules():
+        if not isinstance(module, Convolution) or not hasattr(module, "adn"):
+            continue
+
+        adn = module.adn
+        if isinstance(getattr(adn, "N", None), _BatchNorm) and next(iter(adn._modules)) == "N":
+            module.conv = fuse_conv_bn_eval(module.conv, adn.N, transpose=module.is_transposed)
+            adn.N = torch.nn.Identity()
+            fused += 1
+        if isinstance(getattr(adn, "D", None), torch.nn.Dropout):
+            adn.D = torch.nn.Identity()
+
+    logger.info(f"Fused {fused} Conv+Norm pairs")
+    return network
+
+
+class _FloatNorm(torch.nn.Module):
+    """
+    Run the wrapped normalization in FP32 on FP16 inputs
+    """
+
+    def __init__(self, norm: torch.nn.Module):
+        super().__init__()
+        self.norm = norm.float()
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.norm(x.float()).to(x.dtype)
+
+
+class _HalfPrecision(torch.nn.Module):
+    """
+    Run the wrapped network in FP16 on FP32 windows, keeping the group and layer norms in FP32 as autocast does
+    """
+
+    def __init__(self, network: torch.nn.Module):
+        super().__init__()
+        norms = [
+            (parent, name, child)
+            for parent in network.modules()
+            for name, child in parent.named_children()
+            if isinstance(child, (torch.nn.GroupNorm, torch.nn.LayerNorm))
+        ]
+        self.network = network.half()
+        for parent, name, child in norms:
+            setattr(parent, name, _FloatNorm(child))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.network(x.half())
+
+
+def build_aoti_package(  # noqa: PLR0913
+    network: torch.nn.Module,
+    package_path: str,
+    roi_size: Sequence[int],
+    max_batch_size: int,
+    *,
+    in_channels: int = 1,
+    device: str = "cuda",
+    half: bool = False,
+    atol: float = 5e-2,
+) -> str:
+    """
+    Compile the network ahead of time with AOTInductor into a ``.pt2`` package holding the kernels and the weights
+
+    The window batch dimension is dynamic up to ``max_batch_size``; the window size is fixed. Autocast is not
+    captured by ``torch.export``, so with ``half`` the network itself is converted to FP16, except for the group
+    and layer norms which autocast runs in FP32 (batch and instance norms run in FP16 under autocast). The package
+    is checked against the autocast output of the network on a random batch, and removed if it fails to load or
+    differs by more than ``atol``.
+    """
+    if not aoti_supported():
+        version = ".".join(map(str, AOTI_TORCH_VERSION))
+        raise RuntimeError(f"AOTInductor packages need torch>={version}, found {torch.__version__}")
+
+    device = torch.device(device)
+    network = network.eval().to(device)
+    example = torch.rand((max_batch_size, in_channels, *roi_size), device=device)
+    with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.float16, enabled=half):
+        expected = network(example).float()
+    if half:
+        network = _HalfPrecision(network)
+
+    batch = torch.export.Dim("batch", min=1, max=max_batch_size)
+    with torch.no_grad():
+        program = torch.export.export(network, (example,), dynamic_shapes=({0: batch},))
+        package_path = torch._inductor.aoti_compile_and_package(program, package_path=package_path)
+
+    # the server picks up any package next to the weights, so one that cannot be verified is removed
+    try:
+        with torch.inference_mode(), torch.cuda.device(device):
+            output = torch._inductor.aoti_load_package(package_path)(example).float()
+        difference = (output - expected).abs().max().item()
+        if difference > atol:
+            raise RuntimeError(f"AOTInductor package differs from the autocast network by {difference} (atol {atol})")
+    except BaseException:
+        os.remove(package_path)
+        raise
+
+    logger.info(f"Built AOTInductor package: {package_path} (max difference to autocast {difference:.1e})")
+    return package_path
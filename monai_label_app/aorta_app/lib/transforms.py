@@ -0,0 +1,322 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Hashable, Mapping, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Union
+
+import torch
+import torch._dynamo.exc
+import torch._inductor.exc
+from monai.config import KeysCollection
+from monai.data import ImageReader, MetaTensor
+from monai.transforms import (
+    Compose,
+    EnsureChannelFirstd,
+    FromMetaTensord,
+    LoadImage,
+    LoadImaged,
+    MapTransform,
+    Orientationd,
+    Spacingd,
+    SpatialCrop,
+    ToDeviced,
+    ToMetaTensord,
+)
+from monai.utils import PostFix
+
+from .configs import FOREGROUND_PERCENTILES, INTENSITY_RANGE, TARGET_SPACING
+
+logger = logging.getLogger(__name__)
+
+# raised when torch.compile cannot build a kernel; newer torch raises InductorError for Inductor failures
+COMPILE_ERRORS = (
+    torch._dynamo.exc.BackendCompilerFailed,
+    *filter(None, [getattr(torch._inductor.exc, "InductorError", None)]),
+)
+
+
+def otsu_threshold(values: torch.Tensor, bins: int = 256) -> torch.Tensor:
+    """
+    Otsu threshold of a 1D tensor, computed from its histogram on the tensor's device
+    """
+    lo, hi = values.min(), values.max()
+    hist = torch.histc(values, bins=bins, min=lo.item(), max=hi.item())
+    centers = lo + (torch.arange(bins, device=values.device) + 0.5) * (hi - lo) / bins
+
+    w0 = torch.cumsum(hist, dim=0)
+    w1 = w0[-1] - w0
+    s0 = torch.cumsum(hist * centers, dim=0)
+    m0 = s0 / w0.clamp(min=1)
+    m1 = (s0[-1] - s0) / w1.clamp(min=1)
+
+    # empty bins between the classes give a plateau of equal variance; split it in the middle
+    variance = w0 * w1 * (m0 - m1) ** 2
+    return centers[variance == variance.max()].mean()
+
+
+def scale_intensity_range_(img: torch.Tensor, a_min: float, a_max: float, b_min: float, b_max: float) -> torch.Tensor:
+    """
+    Clip the intensities to [a_min, a_max] and rescale them linearly to [b_min, b_max], in place
+    """
+    return img.clamp_(a_min, a_max).sub_(a_min).mul_((b_max - b_min) / (a_max - a_min)).add_(b_min)
+
+
+class ScaleIntensityRangeTensord(MapTransform):
+    """
+    Clipped ``ScaleIntensityRanged`` on plain tensors
+
+    MONAI's intensity transforms wrap their output in a ``MetaTensor`` while meta tracking is enabled; this one
+    leaves plain tensors plain, so the metadata kept out-of-band by ``FromMetaTensord`` is not recreated.
+    Floating point images are scaled in place; with ``fused`` the clip and rescale are compiled with
+    torch.compile into a single pass over the volume instead of one pass per operation.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        keys: KeysCollection,
+        a_min: float,
+        a_max: float,
+        b_min: float,
+        b_max: float,
+        *,
+        fused: bool = True,
+        allow_missing_keys: bool = False,
+    ):
+        super().__init__(keys, allow_missing_keys)
+        self.a_min = a_min
+        self.a_max = a_max
+        self.b_min = b_min
+        self.b_max = b_max
+        self._scale = scale_intensity_range_
+        if fused:
+            # a single graph, compiled before any of it runs: a failed compilation leaves the image untouched
+            self._scale = torch.compile(scale_intensity_range_, dynamic=True, fullgraph=True)
+
+    def __call__(self, data: Mapping[Hashable, torch.Tensor]) -> dict[Hashable, torch.Tensor]:
+        d = dict(data)
+        for key in self.key_iterator(d):
+            img = d[key] if d[key].is_floating_point() else d[key].float()
+            d[key] = self.scale(img)
+        return d
+
+    def scale(self, img: torch.Tensor) -> torch.Tensor:
+        """
+        Scale a floating point image in place, falling back to the eager kernel if compilation fails
+
+        Only compilation errors switch to the eager kernel; other errors (out of memory, device or input errors)
+        are raised.
+        """
+        if self._scale is scale_intensity_range_:
+            return self._scale(img, self.a_min, self.a_max, self.b_min, self.b_max)
+        try:
+            return self._scale(img, self.a_min, self.a_max, self.b_min, self.b_max)
+        except COMPILE_ERRORS as e:
+            logger.warning(f"Failed to compile the intensity scaling ({e}); using the eager kernel")
+            self._scale = scale_intensity_range_
+            return self._scale(img, self.a_min, self.a_max, self.b_min, self.b_max)
+
+
+class PrefetchLoadImaged(MapTransform):
+    """
+    Load images like ``LoadImaged``, serving the volumes prefetched on background threads
+
+    ``prefetch`` starts reading (and decompressing) a volume on a worker thread, e.g. as soon as the study is
+    selected for labeling, so the IO overlaps with the current inference instead of preceding the next one.
+    A prefetched volume is handed to the first request for its path; other paths are loaded synchronously.
+
+    With ``pin_memory`` the workers also copy prefetched volumes to page-locked memory, so a later
+    ``non_blocking`` copy to a CUDA device is an asynchronous DMA transfer. Pinning is done off the request path
+    only: synchronously loaded volumes stay in pageable memory, as pinning them would cost more than it saves.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        keys: KeysCollection,
+        *,
+        reader: Union[ImageReader, str, None] = None,
+        num_workers: int = 4,
+        cache_size: int = 2,
+        pin_memory: bool = False,
+        allow_missing_keys: bool = False,
+    ):
+        super().__init__(keys, allow_missing_keys)
+        self.loader = LoadImage(reader=reader)
+        self.cache_size = cache_size
+        self.pin_memory = pin_memory
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="prefetch")
+        self._pending: OrderedDict[str, Future] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prefetch(self, path: str):
+        """
+        Start loading the volume at ``path`` in the background, keeping at most ``cache_size`` volumes pending
+        """
+        with self._lock:
+            if path in self._pending:
+                return
+            self._pending[path] = self._executor.submit(self._load_ahead, path)
+            while len(self._pending) > self.cache_size:
+                self._pending.popitem(last=False)[1].cancel()
+
+    def _load_ahead(self, path: str) -> torch.Tensor:
+        img = self.loader(path)
+        return img.pin_memory() if self.pin_memory else img
+
+    def __call__(self, data: Mapping[Hashable, Union[str, torch.Tensor]]) -> dict[Hashable, torch.Tensor]:
+        d = dict(data)
+        for key in self.key_iterator(d):
+            path = d[key]
+            with self._lock:
+                future = self._pending.pop(path, None) if isinstance(path, str) else None
+
+            if future is not None and not future.cancelled():
+                try:
+                    d[key] = future.result()
+                    continue
+                except Exception as e:
+                    logger.warning(f"Prefetch of {path} failed ({e}); loading it again")
+            d[key] = self.loader(path)
+        return d
+
+
+class OtsuCropForegroundd(MapTransform):
+    """
+    Crop the image to the bounding box of an Otsu foreground mask
+
+    The threshold is computed on a subsampled grid, with the intensities clipped to a percentile window, and the
+    bounding box is derived from the per-axis projections of the mask. Boxes are memoized per image path and
+    modification time so repeated requests on the same study skip the computation, while a study rewritten in
+    place gets a new box.
+
+    Plain tensors (with their metadata split out by ``FromMetaTensord``) are sliced directly, and the origin of
+    the affine in their meta dict is moved to the corner of the box.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        keys: KeysCollection,
+        source_key: str,
+        *,
+        path_key: str = "image_path",
+        percentiles: Sequence[float] = (33.0, 99.5),
+        max_samples: int = 1 << 22,
+        cache_size: int = 32,
+        allow_missing_keys: bool = False,
+    ):
+        super().__init__(keys, allow_missing_keys)
+        self.source_key = source_key
+        self.path_key = path_key
+        self.percentiles = percentiles
+        self.max_samples = max_samples
+        self.cache_size = cache_size
+        self._boxes: OrderedDict[tuple[str, float], tuple[list[int], list[int]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, data: Mapping[Hashable, torch.Tensor]) -> dict[Hashable, torch.Tensor]:
+        d = dict(data)
+        source = d[self.source_key]
+
+        path = d.get(self.path_key)
+        if path is None:
+            meta = source.meta if isinstance(source, MetaTensor) else d.get(PostFix.meta(self.source_key), {})
+            path = meta.get("filename_or_obj")
+        try:
+            cache_key = (str(path), os.stat(path).st_mtime) if path else None
+        except OSError:
+            cache_key = None
+
+        with self._lock:
+            box = self._boxes.get(cache_key) if cache_key else None
+            if box is not None:
+                self._boxes.move_to_end(cache_key)
+
+        if box is None:
+            box = self.compute_bounding_box(source)
+            if box is None:
+                logger.warning("No foreground found; skipping crop")
+                return d
+            if cache_key:
+                with self._lock:
+                    self._boxes[cache_key] = box
+                    if len(self._boxes) > self.cache_size:
+                        self._boxes.popitem(last=False)
+
+        for key in self.key_iterator(d):
+            self.crop(d, key, box)
+        return d
+
+    def crop(self, d: dict[Hashable, torch.Tensor], key: Hashable, box: tuple[list[int], list[int]]):
+        """
+        Crop ``d[key]`` to the (start, end) box, updating the affine of its meta dict for plain tensors
+        """
+        img = d[key]
+        if isinstance(img, MetaTensor):
+            d[key] = SpatialCrop(roi_start=box[0], roi_end=box[1])(img)
+            return
+
+        d[key] = img[(slice(None), *(slice(start, end) for start, end in zip(*box)))]
+        meta = d.get(PostFix.meta(key))
+        if meta is not None and "affine" in meta:
+            affine = torch.as_tensor(meta["affine"], dtype=torch.float64).clone()
+            affine[:-1, -1] += affine[:-1, :-1] @ torch.tensor(box[0], dtype=torch.float64)
+            d[PostFix.meta(key)] = {**meta, "affine": affine}
+
+    def compute_bounding_box(self, img: torch.Tensor) -> Optional[tuple[list[int], list[int]]]:
+        """
+        Compute the (start, end) bounding box of the foreground of a channel-first image
+        """
+        img = torch.as_tensor(img)
+        values = img.reshape(-1)
+        values = values[:: max(1, values.numel() // self.max_samples)].float()
+
+        q = torch.tensor(self.percentiles, device=values.device) / 100.0
+        lo, hi = torch.quantile(values, q)
+        threshold = otsu_threshold(values.clamp(lo, hi))
+
+        mask = (img > threshold).any(dim=0)
+        start, end = [], []
+        for axis in range(mask.ndim):
+            dims = tuple(i for i in range(mask.ndim) if i != axis)
+            indices = torch.nonzero(mask.any(dim=dims)).flatten()
+            if indices.numel() == 0:
+                return None
+            lower, upper = indices.aminmax()
+            start.append(int(lower))
+            end.append(int(upper) + 1)
+        return start, end
+
+
+def build_pre_transforms(
+    device: str = "cpu",
+    *,
+    loader: Optional[MapTransform] = None,
+    scale_intensity: Optional[MapTransform] = None,
+    crop_foreground: Optional[MapTransform] = None,
+) -> Compose:
+    """
+    Build the pre-processing pipeline for a device, with new loading, scaling and cropping transforms unless given
+    """
+    transforms = [
+        loader if loader is not None else LoadImaged(keys="image"),
+        EnsureChannelFirstd(keys="image"),
+    ]
+    if torch.device(device).type != "cpu":
+        transforms.append(ToDeviced(keys="image", device=device, non_blocking=True))
+    transforms += [
+        FromMetaTensord(keys="image"),
+        scale_intensity if scale_intensity is not None else ScaleIntensityRangeTensord(keys="image", **INTENSITY_RANGE),
+        crop_foreground
+        if crop_foreground is not None
+        else OtsuCropForegroundd(keys="image", source_key="image", percentiles=FOREGROUND_PERCENTILES),
+        ToMetaTensord(keys="image"),
+        Orientationd(keys="image", axcodes="RAS"),
+        Spacingd(
+            keys="image",
+            pixdim=TARGET_SPACING,
+            mode="bilinear",
+        ),
+        FromMetaTensord(keys="image"),
+    ]
+    return Compose(transforms)
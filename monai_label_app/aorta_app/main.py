@@ -93,6 +93,17 @@ class AortaApp(MONAILabelApp):
             num_res_units=2,
         )
 
+    def next_sample(self, request: dict) -> dict:
+        """
+        Select the next sample for labeling and start loading it for the inference that usually follows
+        """
+        res = super().next_sample(request)
+        if res.get("path"):
+            for task in self._infers.values():
+                if isinstance(task, AortaSegmentation):
+                    task.prefetch(res["path"])
+        return res
+
     def init_datastore(self) -> Datastore:
         """
         Initialize datastore
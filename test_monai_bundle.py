@@ -2,15 +2,20 @@
 Test script for MONAI bundle and MONAI Label application
 """
 
+import gc
 import os
 import sys
 import tempfile
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable
 
 import nibabel as nib
 import numpy as np
 import torch
 
+if TYPE_CHECKING:
+    from lib.infers import AortaSegmentation
+
 
 def test_monai_bundle() -> bool:
     """Test MONAI bundle loading and inference"""
@@ -162,6 +167,520 @@ def test_preprocessing_pipeline() -> bool:
         return False
 
 
+def test_foreground_crop() -> bool:
+    """Test the Otsu foreground crop and its bounding box cache"""
+    print("\nTesting foreground crop...")
+
+    try:
+        app_path = Path("monai_label_app/aorta_app")
+        sys.path.insert(0, str(app_path))
+
+        from lib.transforms import OtsuCropForegroundd
+
+        rng = np.random.default_rng(0)
+        image = rng.uniform(0.0, 0.05, size=(1, 64, 64, 64)).astype(np.float32)
+        image[:, 10:50, 20:40, 5:60] += 0.5
+
+        # the box is cached by the path and modification time of the study, so it needs a file on disk
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "volume.nii.gz")
+            nib.save(nib.Nifti1Image(image[0], np.eye(4)), path)
+
+            crop = OtsuCropForegroundd(keys="image", source_key="image")
+            cropped = crop({"image": torch.as_tensor(image), "image_path": path})
+
+            expected = (1, 40, 20, 55)
+            if tuple(cropped["image"].shape) != expected:
+                print(f"❌ Unexpected crop shape: {tuple(cropped['image'].shape)} (expected {expected})")
+                return False
+            print(f"✅ Foreground cropped to {tuple(cropped['image'].shape)}")
+
+            if (path, os.path.getmtime(path)) not in crop._boxes:
+                print("❌ Bounding box was not cached")
+                return False
+            print("✅ Bounding box cached by image path")
+
+            # a study rewritten in place gets a new box
+            shifted = np.roll(image, 4, axis=1)
+            nib.save(nib.Nifti1Image(shifted[0], np.eye(4)), path)
+            os.utime(path, (0, os.path.getmtime(path) + 1))
+            recropped = crop({"image": torch.as_tensor(shifted), "image_path": path})
+            if not torch.equal(recropped["image"], torch.as_tensor(shifted)[:, 14:54, 20:40, 5:60]):
+                print("❌ Stale bounding box used for a rewritten study")
+                return False
+            print("✅ Bounding box recomputed for a rewritten study")
+
+        print("✅ Foreground crop test passed")
+        return True
+
+    except Exception as e:
+        print(f"❌ Foreground crop test failed: {e}")
+        import traceback
+
+        traceback.print_exc()
+        return False
+
+
+def test_preprocessing_metadata() -> bool:
+    """Test that the plain tensor preprocessing matches the MetaTensor pipeline, affine included"""
+    print("\nTesting preprocessing metadata...")
+
+    try:
+        app_path = Path("monai_label_app/aorta_app")
+        sys.path.insert(0, str(app_path))
+
+        from lib.configs import FOREGROUND_PERCENTILES, INTENSITY_RANGE, TARGET_SPACING
+        from lib.transforms import OtsuCropForegroundd, PrefetchLoadImaged, ScaleIntensityRangeTensord
+        from monai.transforms import (
+            Compose,
+            EnsureChannelFirstd,
+            FromMetaTensord,
+            LoadImaged,
+            Orientationd,
+            ScaleIntensityRanged,
+            Spacingd,
+            ToMetaTensord,
+        )
+
+        # an LPS oriented, anisotropic CT with the body off-center, so cropping moves the origin
+        rng = np.random.default_rng(0)
+        volume = np.full((80, 70, 50), -1000, dtype=np.int16)
+        volume[15:60, 20:65, 8:45] = rng.integers(-150, 300, size=(45, 45, 37))
+        affine = np.array([[-0.8, 0, 0, 120], [0, -0.9, 0, -30], [0, 0, 2.5, -400], [0, 0, 0, 1]])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "volume.nii.gz")
+            nib.save(nib.Nifti1Image(volume, affine), path)
+
+            crop = {"keys": "image", "source_key": "image", "percentiles": FOREGROUND_PERCENTILES}
+            spacing = {"keys": "image", "pixdim": TARGET_SPACING, "mode": "bilinear"}
+            baseline = Compose(
+                [
+                    LoadImaged(keys="image"),
+                    EnsureChannelFirstd(keys="image"),
+                    ScaleIntensityRanged(keys="image", **INTENSITY_RANGE, clip=True),
+                    OtsuCropForegroundd(**crop),
+                    Orientationd(keys="image", axcodes="RAS"),
+                    Spacingd(**spacing),
+                ]
+            )
+
+            # the order of AortaSegmentation._build_pre_transforms on the CPU, with a prefetched volume
+            loader = PrefetchLoadImaged(keys="image", num_workers=1)
+            pipeline = Compose(
+                [
+                    loader,
+                    EnsureChannelFirstd(keys="image"),
+                    FromMetaTensord(keys="image"),
+                    ScaleIntensityRangeTensord(keys="image", **INTENSITY_RANGE, fused=False),
+                    OtsuCropForegroundd(**crop),
+                    ToMetaTensord(keys="image"),
+                    Orientationd(keys="image", axcodes="RAS"),
+                    Spacingd(**spacing),
+                    FromMetaTensord(keys="image"),
+                ]
+            )
+
+            expected = baseline({"image": path})["image"]
+            loader.prefetch(path)
+            prefetched = loader._pending.get(path)
+            output = pipeline({"image": path})
+            if prefetched is None or not prefetched.done() or loader._pending:
+                print("❌ Prefetched volume was not used")
+                return False
+
+        image, meta = output["image"], output["image_meta_dict"]
+        if type(image) is not torch.Tensor or image.shape != expected.shape:
+            print(
+                f"❌ Unexpected output: {type(image).__name__} {tuple(image.shape)} (expected {tuple(expected.shape)})"
+            )
+            return False
+        difference = (image - expected.as_tensor()).abs().max().item()
+        same_affine = torch.allclose(torch.as_tensor(meta["affine"], dtype=torch.float64), expected.affine.double())
+        if not torch.allclose(image, expected.as_tensor(), atol=1e-6) or not same_affine:
+            print(f"❌ Output differs from the MetaTensor pipeline by {difference}, affine:\n{meta['affine']}")
+            return False
+        print(f"✅ Output {tuple(image.shape)} and affine match the MetaTensor pipeline (max diff {difference:.1e})")
+
+        # the compiled scaling (eager where compilation is unavailable) on integer and float images
+        scale = ScaleIntensityRangeTensord(keys="image", **INTENSITY_RANGE)
+        reference = ScaleIntensityRanged(keys="image", **INTENSITY_RANGE, clip=True)
+        for values in (torch.as_tensor(volume[None]), torch.as_tensor(volume[None], dtype=torch.float32)):
+            scaled = scale({"image": values.clone()})["image"]
+            if not torch.allclose(scaled, torch.as_tensor(reference({"image": values})["image"]), atol=1e-6):
+                print(f"❌ Intensity scaling differs from ScaleIntensityRanged for {values.dtype}")
+                return False
+        print("✅ Intensity scaling matches ScaleIntensityRanged")
+
+        print("✅ Preprocessing metadata test passed")
+        return True
+
+    except Exception as e:
+        print(f"❌ Preprocessing metadata test failed: {e}")
+        import traceback
+
+        traceback.print_exc()
+        return False
+
+
+def _sliding_window_case() -> tuple[torch.nn.Module, dict, list[torch.Tensor], list[torch.Tensor]]:
+    """Network, inferer settings, volumes and MONAI's stitched outputs shared by the sliding window tests"""
+    app_path = Path("monai_label_app/aorta_app")
+    sys.path.insert(0, str(app_path))
+
+    from lib.configs import NETWORK_CONFIG
+    from monai.inferers import SlidingWindowInferer
+    from monai.networks.nets import UNet
+
+    network = UNet(**NETWORK_CONFIG).eval()
+    settings = {"roi_size": [32, 32, 32], "sw_batch_size": 2, "overlap": 0.5, "mode": "gaussian"}
+
+    # same shape twice, then smaller, larger and smaller again: the pooled buffers are reused through views
+    shapes = [(40, 48, 70), (40, 48, 70), (30, 36, 50), (44, 52, 76), (30, 36, 50)]
+    volumes = [torch.rand(1, 1, *shape) for shape in shapes]
+    with torch.no_grad():
+        expected = [SlidingWindowInferer(**settings)(inputs, network) for inputs in volumes]
+    return network, settings, volumes, expected
+
+
+def test_sliding_window_stitching() -> bool:
+    """Test that the sliding window stitching matches MONAI"""
+    print("\nTesting sliding window stitching...")
+
+    try:
+        network, settings, volumes, expected = _sliding_window_case()
+
+        from lib.inferers import AortaSlidingWindowInferer, PoolBudget
+
+        with torch.no_grad():
+            for buffer_steps, pool_bytes in ((None, None), (1, None), (1, 0)):
+                inferer = AortaSlidingWindowInferer(
+                    **settings, buffer_steps=buffer_steps, pool_buffers=True, pool_budget=PoolBudget(pool_bytes)
+                )
+                for inputs, reference in zip(volumes, expected):
+                    output = inferer(inputs, network)
+                    if output.shape != reference.shape or not torch.allclose(output, reference, atol=1e-4):
+                        print(f"❌ Pooled output differs from MONAI for {tuple(inputs.shape)}")
+                        return False
+                print(f"✅ Pooled output matches MONAI (buffer_steps={buffer_steps}, pool_bytes={pool_bytes})")
+
+        print("✅ Sliding window stitching test passed")
+        return True
+
+    except Exception as e:
+        print(f"❌ Sliding window stitching test failed: {e}")
+        import traceback
+
+        traceback.print_exc()
+        return False
+
+
+def test_fp16_buffers() -> bool:
+    """Test that FP16 buffers quantize the stitched output only"""
+    print("\nTesting FP16 stitching buffers...")
+
+    try:
+        network, settings, volumes, expected = _sliding_window_case()
+
+        from lib.inferers import AortaSlidingWindowInferer
+
+        # the network still gets FP32 windows
+        window_dtypes = set()
+
+        def probe(x: torch.Tensor) -> torch.Tensor:
+            window_dtypes.add(x.dtype)
+            return network(x)
+
+        with torch.no_grad():
+            for pool_buffers in (False, True):
+                inferer = AortaSlidingWindowInferer(**settings, buffer_dtype=torch.float16, pool_buffers=pool_buffers)
+                for inputs, reference in zip(volumes, expected):
+                    output = inferer(inputs, probe)
+                    if output.dtype != torch.float16 or not torch.allclose(output.float(), reference, atol=1e-2):
+                        print(f"❌ FP16 buffer output differs from FP32 stitching for {tuple(inputs.shape)}")
+                        return False
+                print(f"✅ FP16 buffer output matches FP32 stitching (pool_buffers={pool_buffers})")
+
+        if window_dtypes != {torch.float32}:
+            print(f"❌ Windows were cast for the FP16 buffers: {window_dtypes}")
+            return False
+        print("✅ Windows keep their FP32 intensities")
+
+        print("✅ FP16 stitching buffers test passed")
+        return True
+
+    except Exception as e:
+        print(f"❌ FP16 stitching buffers test failed: {e}")
+        import traceback
+
+        traceback.print_exc()
+        return False
+
+
+def test_pooled_buffers() -> bool:
+    """Test that pooled buffers leave the caller its output, and stay within their shared budget"""
+    print("\nTesting pooled stitching buffers...")
+
+    try:
+        network, settings, volumes, expected = _sliding_window_case()
+
+        from lib.inferers import AortaSlidingWindowInferer, PoolBudget
+
+        with torch.no_grad():
+            # the caller owns the output: a later call on the same thread must not overwrite a kept result
+            inferer = AortaSlidingWindowInferer(**settings, pool_buffers=True)
+            kept = inferer(volumes[0], network)
+            inferer(volumes[3], network)
+            if not torch.allclose(kept, expected[0], atol=1e-4):
+                print("❌ Kept output was overwritten by the next call")
+                return False
+            print("✅ Kept output survives the next call")
+
+            # inferers sharing a budget pool within it, and give the bytes back once their buffers are freed
+            budget = PoolBudget(1 << 30)
+            inferers = [AortaSlidingWindowInferer(**settings, pool_buffers=True, pool_budget=budget) for _ in range(2)]
+            pooled = []
+            for inferer in inferers:
+                inferer(volumes[0], network)
+                pooled.append(budget.used)
+            del inferer, inferers
+            gc.collect()
+
+        if not 0 < pooled[0] < pooled[1] or budget.used != 0:
+            print(f"❌ Shared pool budget accounting is wrong: {pooled} pooled, {budget.used} after release")
+            return False
+        print("✅ Shared pool budget accounts for both inferers")
+
+        print("✅ Pooled stitching buffers test passed")
+        return True
+
+    except Exception as e:
+        print(f"❌ Pooled stitching buffers test failed: {e}")
+        import traceback
+
+        traceback.print_exc()
+        return False
+
+
+def _inference_task() -> "AortaSegmentation":
+    """Set up an AortaSegmentation with the state used by the tests"""
+    app_path = Path("monai_label_app/aorta_app")
+    sys.path.insert(0, str(app_path))
+
+    from lib.inferers import PoolBudget
+    from lib.infers import AortaSegmentation
+
+    # AortaSegmentation cannot be constructed with the installed monailabel, so only the state used is set up
+    task = AortaSegmentation.__new__(AortaSegmentation)
+    task._pool_budget = PoolBudget(0)
+    task._inferers = {interactive: task._build_inferer(interactive) for interactive in (False, True)}
+    task._inverse_transforms = {probs: task._build_inverse_transforms(probs) for probs in (False, True)}
+    task._predictors = {}
+    return task
+
+
+def test_inferer_selection() -> bool:
+    """Test that requests get their inferer, and the predictor exported for their device"""
+    print("\nTesting inferer selection...")
+
+    try:
+        task = _inference_task()
+
+        from lib.configs import INFERENCE_CONFIG, NETWORK_CONFIG
+        from monailabel.utils.others.generic import name_to_device
+
+        # interactive by default, the full overlap with Gaussian blending for final requests
+        for data, overlap, mode in (
+            (None, "interactive_overlap", "interactive_mode"),
+            ({"interactive": "false"}, "overlap", "mode"),
+        ):
+            inferer = task.inferer(data).args[0]
+            if (inferer.overlap, inferer.mode) != (INFERENCE_CONFIG[overlap], INFERENCE_CONFIG[mode]):
+                print(f"❌ Wrong inferer for {data}: overlap {inferer.overlap}, mode {inferer.mode}")
+                return False
+        print("✅ Interactive and final requests get their inferers")
+
+        # the predictor exported for the request device replaces the network, other devices run the network
+        calls = []
+
+        def recorder(name: str) -> Callable[[torch.Tensor], torch.Tensor]:
+            def forward(x: torch.Tensor) -> torch.Tensor:
+                calls.append(name)
+                return torch.zeros((x.shape[0], NETWORK_CONFIG["out_channels"], *x.shape[2:]))
+
+            return forward
+
+        device = name_to_device("cuda")
+        task._predictors[device] = recorder("predictor")
+        inputs = torch.rand(1, 1, *INFERENCE_CONFIG["roi_size"])
+        for request_device, expected in ((device, "predictor"), ("cpu", "network")):
+            calls.clear()
+            task.inferer({"device": request_device})(inputs, recorder("network"))
+            if set(calls) != {expected}:
+                print(f"❌ Windows on {request_device} ran through {set(calls)} instead of {expected}")
+                return False
+        print("✅ The exported predictor is used for its device only")
+
+        print("✅ Inferer selection test passed")
+        return True
+
+    except Exception as e:
+        print(f"❌ Inferer selection test failed: {e}")
+        import traceback
+
+        traceback.print_exc()
+        return False
+
+
+def test_exported_staleness() -> bool:
+    """Test that exports missing or older than the weights are not loaded"""
+    print("\nTesting exported model staleness...")
+
+    try:
+        task = _inference_task()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            task.model_path = os.path.join(temp_dir, "model.pt")
+            path = os.path.join(temp_dir, "model.engine")
+            Path(task.model_path).touch()
+            model_mtime = os.path.getmtime(task.model_path)
+
+            def load(path: str, device: str) -> tuple[str, str]:
+                return path, device
+
+            missing = task._load_exported(path, "cuda", load, model_mtime)
+            Path(path).touch()
+            os.utime(path, (model_mtime - 10, model_mtime - 10))
+            stale = task._load_exported(path, "cuda", load, model_mtime)
+            os.utime(path, (model_mtime + 10, model_mtime + 10))
+            fresh = task._load_exported(path, "cuda", load, model_mtime)
+
+        if missing is not None or stale is not None or fresh != (path, "cuda"):
+            print(f"❌ Wrong exports loaded: missing {missing}, stale {stale}, fresh {fresh}")
+            return False
+        print("✅ Exports older than the weights are ignored")
+
+        print("✅ Exported model staleness test passed")
+        return True
+
+    except Exception as e:
+        print(f"❌ Exported model staleness test failed: {e}")
+        import traceback
+
+        traceback.print_exc()
+        return False
+
+
+def test_model_check() -> bool:
+    """Test that is_valid caches a found model file and checks a missing one again"""
+    print("\nTesting model file check...")
+
+    try:
+        task = _inference_task()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            task.model_path = os.path.join(temp_dir, "model.pt")
+            task._valid = False
+            missing = task.is_valid()
+            Path(task.model_path).touch()
+            found = task.is_valid()
+            os.remove(task.model_path)
+            cached = task.is_valid()
+
+        if missing or not found or not cached:
+            print(f"❌ is_valid does not cache the model file check: {missing}, {found}, {cached}")
+            return False
+        print("✅ is_valid caches the model file check")
+
+        print("✅ Model file check test passed")
+        return True
+
+    except Exception as e:
+        print(f"❌ Model file check test failed: {e}")
+        import traceback
+
+        traceback.print_exc()
+        return False
+
+
+def test_inverse_transforms() -> bool:
+    """Test the label map inverse, with and without return_probs"""
+    print("\nTesting inverse transforms...")
+
+    try:
+        task = _inference_task()
+
+        from lib.configs import NETWORK_CONFIG
+
+        # the label map is the argmax of the logits; probabilities only when asked for
+        logits = torch.randn(NETWORK_CONFIG["out_channels"], 8, 8, 8)
+        labels = task.inverse_transforms()({"pred": logits.clone()})
+        output = task.inverse_transforms({"return_probs": "true"})({"pred": logits.clone()})
+        expected = logits.argmax(0, keepdim=True).to(torch.uint8)
+        if "probs" in labels or not torch.equal(torch.as_tensor(labels["pred"]), expected):
+            print("❌ Wrong label map without return_probs")
+            return False
+        probs = torch.as_tensor(output["probs"])
+        if not torch.equal(torch.as_tensor(output["pred"]), expected) or not torch.allclose(
+            probs, torch.softmax(logits, 0), atol=1e-6
+        ):
+            print("❌ Wrong label map or probabilities with return_probs")
+            return False
+        print("✅ return_probs adds the softmax probabilities next to the label map")
+
+        print("✅ Inverse transforms test passed")
+        return True
+
+    except Exception as e:
+        print(f"❌ Inverse transforms test failed: {e}")
+        import traceback
+
+        traceback.print_exc()
+        return False
+
+
+def test_cuda_graph_predictor() -> bool:
+    """Test that the CUDA graph predictor matches the eager network, on a short final batch too"""
+    print("\nTesting CUDA graph predictor...")
+
+    if not torch.cuda.is_available():
+        print("⏭️  No CUDA device; skipping")
+        return True
+
+    try:
+        app_path = Path("monai_label_app/aorta_app")
+        sys.path.insert(0, str(app_path))
+
+        from lib.configs import NETWORK_CONFIG
+        from lib.inferers import CUDAGraphPredictor
+        from monai.networks.nets import UNet
+
+        network = UNet(**NETWORK_CONFIG).cuda().eval()
+        roi_size, sw_batch_size = (32, 32, 32), 4
+        predictor = CUDAGraphPredictor(network, roi_size, sw_batch_size, device="cuda")
+
+        # a full batch, then a shorter last batch replayed with stale windows in the remaining rows
+        for n in (sw_batch_size, 2):
+            windows = torch.rand(n, 1, *roi_size, device="cuda")
+            with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=torch.float16):
+                expected = network(windows)
+                output = predictor(windows)
+            if output.shape != expected.shape or not torch.allclose(output, expected, atol=1e-2):
+                print(f"❌ CUDA graph output differs from the eager network for {n} windows")
+                return False
+            print(f"✅ CUDA graph output matches the eager network for {n} windows")
+
+        print("✅ CUDA graph predictor test passed")
+        return True
+
+    except Exception as e:
+        print(f"❌ CUDA graph predictor test failed: {e}")
+        import traceback
+
+        traceback.print_exc()
+        return False
+
+
 def main() -> bool:
     """Run all tests"""
     print("🧪 Testing MONAI Bundle and MONAI Label Application")
@@ -173,6 +692,16 @@ def main() -> bool:
         test_monai_bundle,
         test_monai_label_app,
         test_preprocessing_pipeline,
+        test_foreground_crop,
+        test_preprocessing_metadata,
+        test_sliding_window_stitching,
+        test_fp16_buffers,
+        test_pooled_buffers,
+        test_inferer_selection,
+        test_exported_staleness,
+        test_model_check,
+        test_inverse_transforms,
+        test_cuda_graph_predictor,
     ]
 
     results = []
@@ -183,7 +712,21 @@ def main() -> bool:
 
     print("=" * 60)
     print("📊 Test Summary:")
-    test_names = ["MONAI Bundle", "MONAI Label App", "Preprocessing Pipeline"]
+    test_names = [
+        "MONAI Bundle",
+        "MONAI Label App",
+        "Preprocessing Pipeline",
+        "Foreground Crop",
+        "Preprocessing Metadata",
+        "Sliding Window Stitching",
+        "FP16 Stitching Buffers",
+        "Pooled Stitching Buffers",
+        "Inferer Selection",
+        "Exported Model Staleness",
+        "Model File Check",
+        "Inverse Transforms",
+        "CUDA Graph Predictor",
+    ]
 
     for name, result in zip(test_names, results):
         status = "✅ PASSED" if result else "❌ FAILED"